@@ -1,15 +1,25 @@
 import os
 import pickle
+import queue
+import threading
+import time
 import logging
-from flask import Flask, render_template, jsonify, request, session
+from datetime import datetime
+import numpy as np
+import orjson
+from flask import Flask, Response, render_template, jsonify, request, session
+from flask_orjson import OrjsonProvider
+from sqlalchemy.orm import aliased
 from werkzeug.middleware.proxy_fix import ProxyFix
 from models import db, Movie, User, UserRating, Recommendation, RecommendationHistory, SimilarityMatrix
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (set LOG_LEVEL=DEBUG for verbose output)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 
 # Create Flask app
 app = Flask(__name__)
+app.json_provider_class = OrjsonProvider
+app.json = OrjsonProvider(app)
 app.secret_key = os.environ.get("SESSION_SECRET", "movie-recommender-secret-key")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
@@ -26,10 +36,44 @@ db.init_app(app)
 # Global variables to store loaded data
 movie_data = None
 similarity_matrix = None
+TITLES_NP = None
+TITLE_TO_INDEX = {}
+TOP_INDICES = None
+TOP_SCORES = None
+
+# Database movie ids by title, preloaded at startup: {title: movie_id}
+TITLE_TO_MOVIE_ID = {}
+
+# Top-10 recommendations per source title, prebuilt from the database:
+# {title: (source_movie_id, [{'title': ..., 'similarity_score': ...}, ...])}
+REC_CACHE = {}
+
+# Recommendation history rows waiting to be written by the background writer;
+# rows are dropped (and counted) rather than blocking requests when it is full
+HIST_Q = queue.Queue(maxsize=10000)
+history_dropped = 0
+
+def derived_file_is_current(path, rows):
+    """Check that a derived .npy file matches the movie list and is newer than its source pickles"""
+    if not os.path.exists(path):
+        return False
+    
+    for source in ('movie_list.pkl', 'similarity.pkl'):
+        if os.path.exists(source) and os.path.getmtime(path) < os.path.getmtime(source):
+            app.logger.warning(f"Ignoring {path}: older than {source}")
+            return False
+    
+    # Reading the header through a memory map does not touch the data
+    file_rows = np.load(path, mmap_mode='r').shape[0]
+    if file_rows != rows:
+        app.logger.warning(f"Ignoring {path}: {file_rows} rows for {rows} movies")
+        return False
+    
+    return True
 
 def load_data():
     """Load pickle files containing movie data and similarity matrix"""
-    global movie_data, similarity_matrix
+    global movie_data, similarity_matrix, TITLES_NP, TITLE_TO_INDEX, TOP_INDICES, TOP_SCORES
     
     try:
         # Load movie list
@@ -37,17 +81,46 @@ def load_data():
             with open('movie_list.pkl', 'rb') as f:
                 movie_data = pickle.load(f)
             app.logger.info(f"Loaded {len(movie_data)} movies from movie_list.pkl")
+            
+            # Precompute title lookups so requests avoid pandas indexing
+            TITLES_NP = movie_data['title'].to_numpy(dtype=object)
+            TITLE_TO_INDEX = {}
+            for i, title in enumerate(TITLES_NP):
+                TITLE_TO_INDEX.setdefault(title, i)
         else:
             app.logger.error("movie_list.pkl not found")
             return False
             
-        # Load similarity matrix
-        if os.path.exists('similarity.pkl'):
+        # Prefer the precomputed top 10 tables, which make the full
+        # similarity matrix unnecessary at request time, unless they were
+        # generated for a different movie list
+        if (derived_file_is_current('similarity_top_indices.npy', len(movie_data))
+                and derived_file_is_current('similarity_top_scores.npy', len(movie_data))):
+            TOP_INDICES = np.load('similarity_top_indices.npy')
+            TOP_SCORES = np.load('similarity_top_scores.npy')
+            app.logger.info(f"Loaded top recommendation tables with shape: {TOP_INDICES.shape}")
+        
+        # Load similarity matrix, preferring the memory-mapped .npy copy so
+        # rows are paged in on demand and shared between workers, unless it
+        # is a leftover from an older similarity.pkl
+        elif derived_file_is_current('similarity.npy', len(movie_data)):
+            similarity_matrix = np.load('similarity.npy', mmap_mode='r')
+            app.logger.info(
+                f"Memory-mapped similarity matrix with shape: {similarity_matrix.shape}, "
+                f"dtype: {similarity_matrix.dtype}, size: {similarity_matrix.nbytes} bytes"
+            )
+        elif os.path.exists('similarity.pkl'):
             with open('similarity.pkl', 'rb') as f:
                 similarity_matrix = pickle.load(f)
-            app.logger.info(f"Loaded similarity matrix with shape: {similarity_matrix.shape}")
+            
+            # Store as contiguous float32 so each row scan moves half the bytes
+            similarity_matrix = np.ascontiguousarray(similarity_matrix, dtype=np.float32)
+            app.logger.info(
+                f"Loaded similarity matrix with shape: {similarity_matrix.shape}, "
+                f"dtype: {similarity_matrix.dtype}, size: {similarity_matrix.nbytes} bytes"
+            )
         else:
-            app.logger.error("similarity.pkl not found")
+            app.logger.error("similarity_top_*.npy / similarity.npy / similarity.pkl not found")
             return False
             
         return True
@@ -56,36 +129,198 @@ def load_data():
         app.logger.error(f"Error loading data files: {str(e)}")
         return False
 
-# Create database tables and load data on startup
-with app.app_context():
+def load_movie_index():
+    """Preload TITLE_TO_MOVIE_ID from a single id/title query"""
+    global TITLE_TO_MOVIE_ID
+    
+    try:
+        rows = db.session.execute(db.select(Movie.id, Movie.title).order_by(Movie.id)).all()
+        
+        index = {}
+        for movie_id, title in rows:
+            index.setdefault(title, movie_id)
+        
+        TITLE_TO_MOVIE_ID = index
+        app.logger.info(f"Indexed {len(TITLE_TO_MOVIE_ID)} movie titles from the database")
+        return True
+        
+    except Exception as e:
+        app.logger.error(f"Error building movie title index: {str(e)}")
+        return False
+
+def load_recommendation_cache():
+    """Prebuild REC_CACHE from the recommendations table with a single join query"""
+    global REC_CACHE
+    
     try:
-        db.create_all()
-        app.logger.info("Database tables created successfully")
+        source = aliased(Movie)
+        target = aliased(Movie)
+        rows = db.session.query(
+            source.id, source.title, target.title, Recommendation.similarity_score
+        ).join(
+            source, Recommendation.source_movie_id == source.id
+        ).join(
+            target, Recommendation.recommended_movie_id == target.id
+        ).filter(
+            Recommendation.rank <= 10
+        ).order_by(
+            source.id, Recommendation.rank
+        ).all()
+        
+        cache = {}
+        for source_id, source_title, target_title, score in rows:
+            # Titles are not unique; like load_movie_index, keep only the
+            # lowest id (rows arrive ordered by source id)
+            if source_title in cache and cache[source_title][0] != source_id:
+                continue
+
+            entry = cache.setdefault(source_title, (source_id, []))
+            entry[1].append({
+                'title': target_title,
+                'similarity_score': round(float(score), 4)
+            })
+        
+        REC_CACHE = cache
+        app.logger.info(f"Cached recommendations for {len(REC_CACHE)} movies")
+        return True
+        
     except Exception as e:
-        app.logger.error(f"Error creating database tables: {str(e)}")
+        app.logger.error(f"Error building recommendation cache: {str(e)}")
+        return False
+
+def log_recommendation_request(source_movie_id):
+    """Queue a recommendation history row for the background writer"""
+    global history_dropped
+    
+    try:
+        HIST_Q.put_nowait({
+            'source_movie_id': source_movie_id,
+            'session_id': session.get('session_id'),
+            'user_agent': request.headers.get('User-Agent'),
+            'ip_address': request.remote_addr,
+            'created_at': datetime.utcnow()
+        })
+    except queue.Full:
+        history_dropped += 1
+
+def _drain_history():
+    """Bulk-insert queued recommendation history rows every 250ms"""
+    while True:
+        time.sleep(0.25)
+        
+        items = []
+        while True:
+            try:
+                items.append(HIST_Q.get_nowait())
+            except queue.Empty:
+                break
+        
+        if not items:
+            continue
+        
+        with app.app_context():
+            try:
+                db.session.bulk_insert_mappings(RecommendationHistory, items)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.warning(f"Failed to log {len(items)} recommendation requests: {str(e)}")
+
+# Set by start_app(); routes fall back to the database until data is loaded
+data_loaded = False
+
+# Whether start_app() has run in this process, and the lock guarding it
+app_started = False
+_start_lock = threading.Lock()
+
+def start_app():
+    """Create tables, load data and caches, and start the history writer
+    
+    Run by the entry points (main.py and python app.py), or on the first
+    request for any other launcher (flask run, other WSGI targets), rather
+    than at import time, so scripts such as migrate_data.py can import the
+    app without opening database connections or starting threads. Only the
+    first call does anything.
+    """
+    global data_loaded, app_started
+    
+    with _start_lock:
+        if app_started:
+            return
+        
+        # Create database tables and load data on startup
+        with app.app_context():
+            try:
+                db.create_all()
+                app.logger.info("Database tables created successfully")
+            except Exception as e:
+                app.logger.error(f"Error creating database tables: {str(e)}")
+            
+            load_movie_index()
+            load_recommendation_cache()
+        
+        threading.Thread(target=_drain_history, daemon=True).start()
+        
+        # Load data on startup
+        data_loaded = load_data()
+        app_started = True
 
-# Load data on startup
-data_loaded = load_data()
+@app.before_request
+def ensure_started():
+    """Start the app on the first request if the entry point did not"""
+    if not app_started:
+        start_app()
+
+# Per-thread scratch rows for the pickle-path top-10 selection, reused
+# across requests so none allocates arrays the size of a matrix row
+_SCRATCH = threading.local()
+
+def scratch_rows(n, dtype):
+    """Return this thread's (values, mask) scratch arrays of length n"""
+    buf = getattr(_SCRATCH, 'buf', None)
+    if buf is None or buf.shape[0] != n or buf.dtype != dtype:
+        _SCRATCH.buf = buf = np.empty(n, dtype=dtype)
+        _SCRATCH.mask = np.empty(n, dtype=bool)
+    return buf, _SCRATCH.mask
+
+def json_response(payload, status=200, option=None):
+    """Encode payload with orjson and wrap it in a JSON response"""
+    return Response(orjson.dumps(payload, option=option), status=status, mimetype='application/json')
 
 @app.route('/')
 def index():
     """Render the main page"""
     return render_template('index.html')
 
+# Cached /api/movies payload, keyed only on the number of movies in the
+# database. The app never writes to the movies table; out-of-band edits that
+# keep the count the same (e.g. renaming a title) are served from the cache
+# until the process restarts.
+_MOVIES_CACHE = {'count': None, 'body': None}
+
 @app.route('/api/movies')
 def get_movies():
     """API endpoint to get list of all movie titles"""
     try:
+        # Reuse the cached payload while the movie count is unchanged
+        movie_count = Movie.query.count()
+        if _MOVIES_CACHE['body'] is not None and _MOVIES_CACHE['count'] == movie_count:
+            return Response(_MOVIES_CACHE['body'], mimetype='application/json')
+        
         # Try to get movies from database first
-        movies = Movie.query.order_by(Movie.title).all()
+        movie_list = [
+            title for (title,) in db.session.query(Movie.title).order_by(Movie.title).all()
+        ] if movie_count else []
         
-        if movies:
-            movie_list = [movie.title for movie in movies]
-            return jsonify({
+        if movie_list:
+            body = orjson.dumps({
                 'movies': movie_list,
                 'count': len(movie_list),
                 'source': 'database'
             })
+            _MOVIES_CACHE['count'] = movie_count
+            _MOVIES_CACHE['body'] = body
+            return Response(body, mimetype='application/json')
         
         # Fallback to pickle file if database is empty
         if not data_loaded or movie_data is None:
@@ -95,11 +330,14 @@ def get_movies():
         
         # Extract movie titles and sort them from pickle
         movie_titles = sorted(movie_data['title'].tolist())
-        return jsonify({
+        body = orjson.dumps({
             'movies': movie_titles,
             'count': len(movie_titles),
             'source': 'pickle'
         })
+        _MOVIES_CACHE['count'] = movie_count
+        _MOVIES_CACHE['body'] = body
+        return Response(body, mimetype='application/json')
         
     except Exception as e:
         app.logger.error(f"Error getting movies: {str(e)}")
@@ -115,80 +353,118 @@ def recommend_movies():
         
         selected_movie = data['movie']
         
+        # Serve prebuilt recommendations straight from memory
+        cached = REC_CACHE.get(selected_movie)
+        if cached is not None:
+            source_movie_id, recommendations = cached
+            log_recommendation_request(source_movie_id)
+            return json_response({
+                'selected_movie': selected_movie,
+                'recommendations': recommendations,
+                'source': 'database'
+            })
+        
         # Try to get recommendations from database first
-        source_movie = Movie.query.filter_by(title=selected_movie).first()
+        source_movie_id = TITLE_TO_MOVIE_ID.get(selected_movie)
+        if source_movie_id is None:
+            # Movies added after startup are not in the preloaded index yet
+            source_movie = Movie.query.filter_by(title=selected_movie).first()
+            if source_movie:
+                source_movie_id = TITLE_TO_MOVIE_ID[selected_movie] = source_movie.id
         
-        if source_movie:
-            # Get recommendations from database
-            db_recommendations = Recommendation.query.filter_by(
-                source_movie_id=source_movie.id
+        if source_movie_id is not None:
+            # Get recommendations from database, selecting only the columns
+            # the response needs in a single join
+            db_recommendations = db.session.query(
+                Movie.title.label('rec_title'), Recommendation.similarity_score
+            ).join(
+                Recommendation, Recommendation.recommended_movie_id == Movie.id
+            ).filter(
+                Recommendation.source_movie_id == source_movie_id
             ).order_by(Recommendation.rank).limit(10).all()
             
             if db_recommendations:
                 recommendations = []
-                for rec in db_recommendations:
+                for rec_title, similarity_score in db_recommendations:
                     recommendations.append({
-                        'title': rec.recommended_movie.title,
-                        'similarity_score': round(float(rec.similarity_score), 4)
+                        'title': rec_title,
+                        'similarity_score': round(float(similarity_score), 4)
                     })
                 
                 # Log recommendation request for analytics
-                try:
-                    history = RecommendationHistory(
-                        source_movie_id=source_movie.id,
-                        session_id=session.get('session_id'),
-                        user_agent=request.headers.get('User-Agent'),
-                        ip_address=request.remote_addr
-                    )
-                    db.session.add(history)
-                    db.session.commit()
-                except Exception as e:
-                    app.logger.warning(f"Failed to log recommendation request: {str(e)}")
+                log_recommendation_request(source_movie_id)
                 
-                return jsonify({
+                return json_response({
                     'selected_movie': selected_movie,
                     'recommendations': recommendations,
                     'source': 'database'
                 })
         
         # Fallback to pickle-based recommendations if database doesn't have the movie
-        if not data_loaded or movie_data is None or similarity_matrix is None:
+        if not data_loaded or movie_data is None or (similarity_matrix is None and TOP_INDICES is None):
             return jsonify({
                 'error': 'Movie not found in database and pickle-based recommendations not available.'
             }), 404
         
-        # Find the movie in the pickle dataset
-        movie_matches = movie_data[movie_data['title'] == selected_movie]
-        if movie_matches.empty:
+        # Find the position of the movie in the pickle dataset
+        movie_index = TITLE_TO_INDEX.get(selected_movie)
+        if movie_index is None:
             return jsonify({'error': f'Movie "{selected_movie}" not found in database or pickle data'}), 404
         
-        # Get the index of the selected movie in pickle data
-        movie_index = movie_matches.index[0]
-        
-        # Calculate similarity scores for all movies
-        similarity_scores = list(enumerate(similarity_matrix[movie_index]))
-        
-        # Sort by similarity score (descending) and exclude the selected movie itself
-        similarity_scores = sorted(similarity_scores, key=lambda x: x[1], reverse=True)
-        
-        # Get top 10 recommendations (excluding the first one which is the movie itself)
-        recommended_indices = [i[0] for i in similarity_scores[1:11]]
+        if TOP_INDICES is not None:
+            # Top 10 recommendations were precomputed offline
+            recommended_indices = TOP_INDICES[movie_index]
+            scores = TOP_SCORES[movie_index]
+        else:
+            # Partition out the 11th highest score (the movie itself plus top
+            # 10) instead of sorting the whole row, then sort only the movies
+            # above it plus the lowest-index movies tied with it, so equal
+            # scores list the lower index first, as a full sort would. Only
+            # those 11 are sorted even when most of the row ties at 0.
+            sims = np.asarray(similarity_matrix[movie_index])
+            k = min(11, sims.size)
+            
+            # Partition a copy in the reused scratch row and build the masks
+            # in place, so the request allocates nothing of size N
+            buf, mask = scratch_rows(sims.size, sims.dtype)
+            np.copyto(buf, sims)
+            buf.partition(sims.size - k)
+            threshold = buf[sims.size - k]
+            np.greater(sims, threshold, out=mask)
+            above = np.flatnonzero(mask)
+            
+            # Walk the tie mask only as far as the ties needed (argmax on a
+            # bool array stops at the first True)
+            np.equal(sims, threshold, out=mask)
+            ties = []
+            pos = 0
+            while len(ties) < k - above.size:
+                pos += int(mask[pos:].argmax())
+                ties.append(pos)
+                pos += 1
+            
+            part = np.concatenate((above, np.array(ties, dtype=above.dtype)))
+            order = part[np.lexsort((part, -sims[part]))]
+            
+            # Get top 10 recommendations, excluding the selected movie itself
+            recommended_indices = order[order != movie_index][:10]
+            scores = sims[recommended_indices]
         
-        # Get movie titles for recommendations
+        # Get movie titles for recommendations; scores stay NumPy scalars,
+        # rounded in one vectorized call and encoded natively by orjson
+        titles = TITLES_NP[recommended_indices]
         recommendations = []
-        for i, idx in enumerate(recommended_indices):
-            movie_title = movie_data.iloc[idx]['title']
-            similarity_score = similarity_scores[i + 1][1]  # Get score from sorted list
+        for movie_title, similarity_score in zip(titles, np.round(scores, 4)):
             recommendations.append({
                 'title': movie_title,
-                'similarity_score': round(float(similarity_score), 4)
+                'similarity_score': similarity_score
             })
         
-        return jsonify({
+        return json_response({
             'selected_movie': selected_movie,
             'recommendations': recommendations,
             'source': 'pickle'
-        })
+        }, option=orjson.OPT_SERIALIZE_NUMPY)
         
     except Exception as e:
         app.logger.error(f"Error generating recommendations: {str(e)}")
@@ -214,8 +490,10 @@ def health_check():
             'database_status': db_status,
             'movie_data_loaded': movie_data is not None,
             'similarity_matrix_loaded': similarity_matrix is not None,
+            'top_recommendations_loaded': TOP_INDICES is not None,
             'movies_in_database': movie_count_db,
-            'recommendations_in_database': recommendation_count_db
+            'recommendations_in_database': recommendation_count_db,
+            'history_dropped': history_dropped
         }
         
         if movie_data is not None:
@@ -224,7 +502,7 @@ def health_check():
         if similarity_matrix is not None:
             status['similarity_matrix_shape'] = similarity_matrix.shape
         
-        return jsonify(status)
+        return json_response(status)
         
     except Exception as e:
         return jsonify({
@@ -242,10 +520,18 @@ def get_movie_details(movie_id):
         app.logger.error(f"Error getting movie details: {str(e)}")
         return jsonify({'error': 'Failed to retrieve movie details'}), 500
 
+# Cached /api/stats payload, rebuilt at most once every STATS_TTL seconds
+STATS_TTL = 30
+_STATS_CACHE = {'ts': 0, 'body': None}
+
 @app.route('/api/stats')
 def get_stats():
     """Get system statistics"""
     try:
+        # Serve the cached payload while it is still fresh
+        if _STATS_CACHE['body'] is not None and time.monotonic() - _STATS_CACHE['ts'] < STATS_TTL:
+            return Response(_STATS_CACHE['body'], mimetype='application/json')
+        
         stats = {
             'total_movies': Movie.query.count(),
             'total_recommendations': Recommendation.query.count(),
@@ -271,7 +557,10 @@ def get_stats():
             for title, count in popular_movies
         ]
         
-        return jsonify(stats)
+        body = orjson.dumps(stats)
+        _STATS_CACHE['ts'] = time.monotonic()
+        _STATS_CACHE['body'] = body
+        return Response(body, mimetype='application/json')
         
     except Exception as e:
         app.logger.error(f"Error getting stats: {str(e)}")
@@ -286,4 +575,6 @@ def internal_error(error):
     return jsonify({'error': 'Internal server error'}), 500
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    start_app()
+    # Debug mode follows the FLASK_DEBUG environment variable
+    app.run(host='0.0.0.0', port=5000)
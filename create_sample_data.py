@@ -7,8 +7,8 @@ This script generates realistic movie data using the same approach as the Jupyte
 import pickle
 import pandas as pd
 import numpy as np
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
 
 # Sample movie data with id, title, genre, and overview (matching the notebook structure)
 movies_data = [
@@ -60,33 +60,92 @@ def create_movie_dataset():
     print(f"Created dataset with {len(df)} movies")
     return df
 
-def calculate_similarity_matrix(df):
-    """Calculate content-based similarity matrix using CountVectorizer (same as notebook)"""
-    print("Calculating similarity matrix...")
+def vectorize_tags(df):
+    """Turn each movie's tags into an L2-normalized HashingVectorizer term count vector"""
+    print("Vectorizing movie tags...")
+    
+    # Stateless hashed term counts avoid building a vocabulary dict. This is
+    # not identical to the notebook's CountVectorizer(max_features=10000):
+    # every term is kept rather than only the 10000 most frequent, and terms
+    # that hash to the same bucket are counted together (in the sample data
+    # 'wants' and 'warthe' collide), so some scores differ from the notebook
+    hv = HashingVectorizer(n_features=2**20, alternate_sign=False, stop_words='english', norm=None)
+    vector = hv.transform(df['tags'].astype('U'))
     
-    # Use CountVectorizer with same parameters as notebook
-    cv = CountVectorizer(max_features=10000, stop_words='english')
-    vector = cv.fit_transform(df['tags'].astype('U')).toarray()
+    # Cosine similarity is then the dot product of two rows
+    return normalize(vector, norm='l2', copy=False)
+
+def calculate_similarity_matrix(vector):
+    """Calculate the dense content-based similarity matrix saved to similarity.pkl"""
+    print("Calculating similarity matrix...")
     
-    # Calculate cosine similarity
-    similarity_matrix = cosine_similarity(vector)
+    similarity_matrix = (vector @ vector.T).toarray()
     
     print(f"Created similarity matrix with shape: {similarity_matrix.shape}")
     return similarity_matrix
 
+def calculate_top_recommendations(vector, top_n=10, chunk_size=2048):
+    """Select the top-N most similar movies per row, excluding the movie itself
+    
+    Similarities are computed from the normalized tag vectors chunk_size
+    rows at a time and kept as float32 (the precision the app serves), so
+    only a chunk_size x N block is ever materialized, never the N x N matrix.
+    """
+    print(f"Selecting top {top_n} recommendations per movie...")
+    
+    n = vector.shape[0]
+    top_n = min(top_n, n - 1)
+    top_indices = np.empty((n, top_n), dtype=np.int32)
+    top_scores = np.empty((n, top_n), dtype=np.float32)
+    
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        sim = (vector[start:stop] @ vector.T).toarray().astype(np.float32)
+        
+        # Mask self-similarity so it never lands in a movie's own top-N
+        sim[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+        
+        # Partition each row in O(N) to find its N-th best score, then sort
+        # only the candidates above it plus the lowest-index ones tied with
+        # it, N in all, breaking exact ties by movie index (as a full stable
+        # sort would) rather than partition order
+        kth = -np.partition(-sim, top_n - 1, axis=1)[:, top_n - 1]
+        for row, (scores, threshold) in enumerate(zip(sim, kth), start):
+            above = np.flatnonzero(scores > threshold)
+            ties = np.flatnonzero(scores == threshold)[:top_n - above.size]
+            idx = np.concatenate((above, ties))
+            idx = idx[np.lexsort((idx, -scores[idx]))]
+            top_indices[row] = idx
+            top_scores[row] = scores[idx]
+    
+    print(f"Created top recommendation tables with shape: {top_indices.shape}")
+    return top_indices, top_scores
+
 def save_pickle_files(df, similarity_matrix):
     """Save the DataFrame and similarity matrix as pickle files"""
     print("Saving pickle files...")
     
     # Save movie data
     with open('movie_list.pkl', 'wb') as f:
-        pickle.dump(df, f)
+        pickle.dump(df, f, protocol=5)
     print("Saved movie_list.pkl")
     
-    # Save similarity matrix
+    # Save similarity matrix (protocol 5 writes the array buffer in one frame)
     with open('similarity.pkl', 'wb') as f:
-        pickle.dump(similarity_matrix, f)
+        pickle.dump(similarity_matrix, f, protocol=5)
     print("Saved similarity.pkl")
+    
+    # Save a float32 .npy copy that the app can memory-map instead of unpickling
+    np.save('similarity.npy', np.ascontiguousarray(similarity_matrix, dtype=np.float32))
+    print("Saved similarity.npy")
+
+def save_top_recommendations(top_indices, top_scores):
+    """Save the per-movie top-N indices and scores as .npy files"""
+    print("Saving top recommendation tables...")
+    
+    np.save('similarity_top_indices.npy', top_indices)
+    np.save('similarity_top_scores.npy', top_scores)
+    print("Saved similarity_top_indices.npy and similarity_top_scores.npy")
 
 def main():
     """Main function to create and save movie recommendation data"""
@@ -95,17 +154,28 @@ def main():
     # Create movie dataset
     movie_df = create_movie_dataset()
     
-    # Calculate similarity matrix
-    similarity = calculate_similarity_matrix(movie_df)
+    # Vectorize tags once for both outputs below
+    vector = vectorize_tags(movie_df)
+    
+    # Calculate similarity matrix (the dense N x N matrix is only needed
+    # for the pickle files)
+    similarity = calculate_similarity_matrix(vector)
     
     # Save to pickle files
     save_pickle_files(movie_df, similarity)
     
+    # Precompute and save the top 10 recommendations per movie straight
+    # from the vectors
+    top_indices, top_scores = calculate_top_recommendations(vector)
+    save_top_recommendations(top_indices, top_scores)
+    
     print("\n=== Data Generation Complete ===")
     print(f"Generated {len(movie_df)} movies with similarity calculations")
     print("Files created:")
     print("- movie_list.pkl (movie dataset)")
     print("- similarity.pkl (similarity matrix)")
+    print("- similarity.npy (memory-mappable similarity matrix)")
+    print("- similarity_top_indices.npy / similarity_top_scores.npy (top 10 per movie)")
     print("\nThe Flask app should now work properly!")
 
 if __name__ == "__main__":
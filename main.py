@@ -1 +1,3 @@
-from app import app
+from app import app, start_app
+
+start_app()
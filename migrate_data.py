@@ -3,30 +3,57 @@
 Database migration script to populate the movie database with data from pickle files
 """
 
+import io
+import os
+import csv
 import pickle
 import logging
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from app import app, db
+from itertools import repeat
+import numpy as np
+import pandas as pd
+from app import app, db, derived_file_is_current
 from models import Movie, Recommendation, SimilarityMatrix
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sqlalchemy import inspect
+from sqlalchemy.dialects import postgresql, sqlite
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 def load_pickle_data():
-    """Load movie data and similarity matrix from pickle files"""
+    """Load movie data and similarity matrix from the pickle / .npy data files"""
     try:
-        # Load movie data
+        # Load movie data, reading the file in one call and unpickling
+        # from memory rather than through many small reads
         with open('movie_list.pkl', 'rb') as f:
-            movie_data = pickle.load(f)
+            movie_data = pickle.loads(f.read())
         logger.info(f"Loaded {len(movie_data)} movies from pickle file")
         
-        # Load similarity matrix
-        with open('similarity.pkl', 'rb') as f:
-            similarity_matrix = pickle.load(f)
-        logger.info(f"Loaded similarity matrix with shape: {similarity_matrix.shape}")
+        # Convert the pickled matrix to a float32 .npy file whenever there is
+        # no copy matching the current pickles, so this and later runs can
+        # memory-map it instead of holding it all in RAM
+        if not derived_file_is_current('similarity.npy', len(movie_data)):
+            with open('similarity.pkl', 'rb') as f:
+                similarity_matrix = pickle.loads(f.read())
+            np.save('similarity.npy', np.ascontiguousarray(similarity_matrix, dtype=np.float32))
+            del similarity_matrix
+            logger.info("Converted similarity.pkl to similarity.npy")
+        
+        # Every phase reads the matrix a row (or block of rows) at a time, so
+        # only the pages being worked on need to be resident
+        similarity_matrix = np.load('similarity.npy', mmap_mode='r')
+        logger.info(f"Memory-mapped similarity matrix with shape: {similarity_matrix.shape}")
+        
+        if similarity_matrix.shape != (len(movie_data), len(movie_data)):
+            logger.error(
+                f"Similarity matrix shape {similarity_matrix.shape} does not match "
+                f"{len(movie_data)} movies in movie_list.pkl"
+            )
+            return None, None
         
         return movie_data, similarity_matrix
         
@@ -34,6 +61,179 @@ def load_pickle_data():
         logger.error(f"Error loading pickle files: {str(e)}")
         return None, None
 
+# Number of rows sent per executemany INSERT / COPY
+BATCH_SIZE = 5000
+
+def insert_ignore(model):
+    """Build a bulk INSERT for model that skips rows violating a unique constraint"""
+    table = model.__table__
+    dialect = db.engine.dialect.name
+    
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return table.insert()
+
+def copy_rows(model, rows):
+    """Stream a batch of row dicts into a PostgreSQL table with COPY
+    
+    Rows are copied into a temporary staging table first so that the final
+    INSERT ... SELECT can still skip rows violating a unique constraint.
+    """
+    table = model.__table__.name
+    stage = f"{table}_stage"
+    columns = ', '.join(rows[0].keys())
+    
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(['\\N' if value is None else value for value in row.values()])
+    buf.seek(0)
+    
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {stage} ON COMMIT DROP AS "
+            f"SELECT {columns} FROM {table} WITH NO DATA"
+        )
+        cursor.execute(f"TRUNCATE {stage}")
+        cursor.copy_expert(f"COPY {stage} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buf)
+        cursor.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {stage} ON CONFLICT DO NOTHING")
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+def upgrade_similarity_matrix():
+    """Bring a similarity_matrix table created before score quantization up to date
+    
+    db.create_all() does not alter existing tables, so databases created
+    before similarity_score_q was added lack that column, keep
+    similarity_score NOT NULL and index the float score instead. Existing
+    float scores are quantized into the new column.
+    """
+    inspector = inspect(db.engine)
+    if not inspector.has_table('similarity_matrix'):
+        return True
+    
+    columns = {column['name']: column for column in inspector.get_columns('similarity_matrix')}
+    if 'similarity_score_q' in columns and columns['similarity_score']['nullable']:
+        return True
+    
+    logger.info("Upgrading similarity_matrix table to quantized scores...")
+    table = SimilarityMatrix.__table__
+    dialect = db.engine.dialect.name
+    
+    try:
+        with db.engine.begin() as connection:
+            if dialect == 'postgresql':
+                if 'similarity_score_q' not in columns:
+                    connection.execute(db.text("ALTER TABLE similarity_matrix ADD COLUMN similarity_score_q SMALLINT"))
+                connection.execute(db.text("ALTER TABLE similarity_matrix ALTER COLUMN similarity_score DROP NOT NULL"))
+                for index in table.indexes:
+                    index.drop(bind=connection, checkfirst=True)
+                    index.create(bind=connection)
+            elif dialect == 'sqlite':
+                # SQLite cannot drop NOT NULL in place, so rebuild the table
+                copied = ', '.join(name for name in table.columns.keys() if name in columns)
+                connection.execute(db.text("ALTER TABLE similarity_matrix RENAME TO similarity_matrix_old"))
+                for index in table.indexes:
+                    connection.execute(db.text(f"DROP INDEX IF EXISTS {index.name}"))
+                table.create(bind=connection)
+                connection.execute(db.text(
+                    f"INSERT INTO similarity_matrix ({copied}) SELECT {copied} FROM similarity_matrix_old"
+                ))
+                connection.execute(db.text("DROP TABLE similarity_matrix_old"))
+            else:
+                logger.error(f"Cannot upgrade similarity_matrix on {dialect}; add similarity_score_q manually")
+                return False
+            
+            connection.execute(db.text(
+                "UPDATE similarity_matrix SET similarity_score_q = ROUND(similarity_score * 127) "
+                "WHERE similarity_score_q IS NULL AND similarity_score IS NOT NULL"
+            ))
+        
+        logger.info("similarity_matrix table upgraded")
+        return True
+        
+    except Exception as e:
+        logger.error(f"Error upgrading similarity_matrix table: {str(e)}")
+        return False
+
+# Memory PostgreSQL may use to rebuild indexes during the migration
+MAINTENANCE_WORK_MEM = '2GB'
+
+def relax_durability():
+    """Speed up the migration transaction on PostgreSQL at the cost of crash safety
+    
+    SET LOCAL lasts only until the migration transaction ends: its commit
+    does not wait for the WAL flush, and index rebuilds get more memory.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    
+    db.session.execute(db.text("SET LOCAL synchronous_commit = OFF"))
+    db.session.execute(db.text(f"SET LOCAL maintenance_work_mem = '{MAINTENANCE_WORK_MEM}'"))
+
+def checkpoint():
+    """Flush the committed migration to disk on PostgreSQL (needs CHECKPOINT privilege)"""
+    if db.engine.dialect.name != 'postgresql':
+        return
+    
+    try:
+        db.session.execute(db.text("CHECKPOINT"))
+        db.session.commit()
+    except Exception as e:
+        logger.warning(f"Could not run CHECKPOINT after migration: {str(e)}")
+        db.session.rollback()
+
+@contextmanager
+def deferred_indexes(model):
+    """Drop a table's secondary indexes for a bulk load and rebuild them afterwards
+    
+    Only done on PostgreSQL, and only when the table starts empty: DROP
+    INDEX holds an ACCESS EXCLUSIVE lock until the migration commits, which
+    would block the live app's queries on a populated table, and re-runs
+    that insert little would rebuild the indexes for nothing. Unique
+    constraints stay in place because the inserts rely on them to skip
+    existing rows.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        yield
+        return
+    
+    if db.session.execute(db.select(model.id).limit(1)).first() is not None:
+        logger.info(f"{model.__tablename__} already has rows; keeping its indexes during the load")
+        yield
+        return
+    
+    connection = db.session.connection()
+    indexes = list(model.__table__.indexes)
+    for index in indexes:
+        index.drop(bind=connection, checkfirst=True)
+    
+    try:
+        yield
+    finally:
+        # Rebuilt inside the migration transaction, so plain CREATE INDEX
+        # (CONCURRENTLY cannot run in a transaction block)
+        for index in indexes:
+            index.create(bind=connection, checkfirst=True)
+        logger.info(f"Rebuilt {len(indexes)} indexes on {model.__tablename__}")
+
+def insert_rows(model, rows):
+    """Insert a batch of row dicts in the current migration transaction
+    
+    PostgreSQL uses COPY; other databases fall back to one executemany
+    INSERT. Returns the number of rows inserted (or sent, if the driver
+    cannot tell).
+    """
+    if db.engine.dialect.name == 'postgresql':
+        return copy_rows(model, rows)
+    
+    result = db.session.execute(insert_ignore(model), rows)
+    return result.rowcount if result.rowcount >= 0 else len(rows)
+
 def migrate_movies(movie_data):
     """Migrate movie data to the database"""
     logger.info("Starting movie data migration...")
@@ -41,183 +241,255 @@ def migrate_movies(movie_data):
     migrated_count = 0
     skipped_count = 0
     
-    for index, row in movie_data.iterrows():
-        try:
-            # Check if movie already exists
-            existing_movie = Movie.query.filter_by(title=row['title']).first()
-            if existing_movie:
-                skipped_count += 1
-                continue
-            
-            # Create new movie record
-            movie = Movie(
-                tmdb_id=row.get('id', None),
-                title=row['title'],
-                genre=row.get('genre', ''),
-                overview=row.get('overview', ''),
-                tags=row['tags'],
-                created_at=datetime.utcnow()
-            )
-            
-            db.session.add(movie)
-            migrated_count += 1
-            
-            # Commit in batches to avoid memory issues
-            if migrated_count % 50 == 0:
-                db.session.commit()
-                logger.info(f"Migrated {migrated_count} movies so far...")
-                
-        except Exception as e:
-            logger.error(f"Error migrating movie '{row['title']}': {str(e)}")
-            db.session.rollback()
-            continue
+    rows = []
+    
+    # One timestamp for the whole phase rather than a clock read per row
+    now = datetime.utcnow()
+    
+    # Load existing titles once; titles queued below are added to the same set
+    seen_titles = set(db.session.scalars(db.select(Movie.title)).all())
+    
+    # Pull columns out as plain Python lists once instead of boxing every row
+    # into a Series; optional columns fall back to the old .get defaults
+    count = len(movie_data)
+    titles = movie_data['title'].tolist()
+    tags = movie_data['tags'].tolist()
+    tmdb_ids = movie_data['id'].tolist() if 'id' in movie_data else [None] * count
+    genres = movie_data['genre'].tolist() if 'genre' in movie_data else [''] * count
+    overviews = movie_data['overview'].tolist() if 'overview' in movie_data else [''] * count
     
-    # Final commit
     try:
-        db.session.commit()
+        # Later phases need these movies, so main() abandons the whole
+        # migration if this phase fails
+        with db.session.begin_nested():
+            for title, tmdb_id, genre, overview, tag in zip(titles, tmdb_ids, genres, overviews, tags):
+                # Check if movie already exists
+                if title in seen_titles:
+                    skipped_count += 1
+                    continue
+                
+                rows.append({
+                    'tmdb_id': int(tmdb_id) if pd.notna(tmdb_id) else None,
+                    'title': title,
+                    'genre': genre,
+                    'overview': overview,
+                    'tags': tag,
+                    'created_at': now
+                })
+                seen_titles.add(title)
+                
+                # Insert in batches to avoid memory issues
+                if len(rows) >= BATCH_SIZE:
+                    migrated_count += insert_rows(Movie, rows)
+                    rows = []
+                    logger.info(f"Migrated {migrated_count} movies so far...")
+            
+            # Insert the final partial batch
+            if rows:
+                migrated_count += insert_rows(Movie, rows)
+            
         logger.info(f"Movie migration completed: {migrated_count} migrated, {skipped_count} skipped")
         return True
+        
     except Exception as e:
-        logger.error(f"Error committing movie data: {str(e)}")
-        db.session.rollback()
+        logger.error(f"Error migrating movie data: {str(e)}")
         return False
 
+def map_movie_ids(titles):
+    """Map titles to database movie ids in one vectorized lookup (0 when missing)"""
+    # Select just the two columns rather than hydrating full Movie objects;
+    # newest first, so a duplicated title ends up with its lowest id, the
+    # one the app's title index (load_movie_index) resolves to
+    movie_id_map = dict(db.session.execute(db.select(Movie.title, Movie.id).order_by(Movie.id.desc())).all())
+    id_series = pd.Series(movie_id_map, dtype=np.int64)
+    return id_series.reindex(titles).fillna(0).to_numpy(dtype=np.int64)
+
+# Above this many movies the top 10 selection is spread over worker processes
+PARALLEL_MIN_ROWS = 5000
+
+# Number of similarity matrix rows read together by the row-block passes
+BLOCK_ROWS = 2048
+
+def select_top_indices(similarity_matrix, start, stop, top_n=10):
+    """Return the top-N most similar row positions for rows [start, stop), excluding each row itself"""
+    results = []
+    for block_start in range(start, stop, BLOCK_ROWS):
+        # Read a block of rows at a time so only a BLOCK_ROWS x N slice
+        # of the memory-mapped matrix is resident
+        block = np.asarray(similarity_matrix[block_start:min(block_start + BLOCK_ROWS, stop)])
+        k = min(top_n + 1, block.shape[1])
+        
+        # Partition out each row's N+1-th highest score (the movie itself plus
+        # top N), then sort only the movies above it plus the lowest-index
+        # movies tied with it, N+1 in all; ties list the lower index first,
+        # as a full stable sort would
+        thresholds = np.partition(block, block.shape[1] - k, axis=1)[:, block.shape[1] - k]
+        for i, (sim_row, threshold) in enumerate(zip(block, thresholds), block_start):
+            above = np.flatnonzero(sim_row > threshold)
+            ties = np.flatnonzero(sim_row == threshold)[:k - above.size]
+            top_idx = np.concatenate((above, ties))
+            top_idx = top_idx[np.lexsort((top_idx, -sim_row[top_idx]))]
+            results.append(top_idx[top_idx != i][:top_n])
+    return results
+
+def _select_top_indices_worker(path, start, stop):
+    """Worker entry point: select top indices for one row range of the .npy matrix at path"""
+    return select_top_indices(np.load(path, mmap_mode='r'), start, stop)
+
+def iter_top_indices(similarity_matrix):
+    """Yield the top 10 row positions for every row of the similarity matrix, in row order
+    
+    Large memory-mapped matrices are split into row ranges that worker
+    processes partition concurrently while the caller inserts the finished
+    ranges. Workers are spawned fresh (inheriting no threads or database
+    connections) and memory-map the .npy file themselves, so the matrix is
+    never pickled; anything else runs in-process.
+    """
+    n = similarity_matrix.shape[0]
+    path = getattr(similarity_matrix, 'filename', None)
+    
+    if n < PARALLEL_MIN_ROWS or path is None:
+        yield from select_top_indices(similarity_matrix, 0, n)
+        return
+    
+    workers = os.cpu_count() or 1
+    step = -(-n // (workers * 4))
+    starts = range(0, n, step)
+    stops = [min(start + step, n) for start in starts]
+    
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        # map returns the ranges in submission order
+        for chunk in executor.map(_select_top_indices_worker, repeat(path), starts, stops):
+            yield from chunk
+
 def migrate_similarity_data(movie_data, similarity_matrix):
     """Migrate similarity data to create recommendations"""
     logger.info("Starting similarity data migration...")
     
-    movies = Movie.query.all()
-    movie_id_map = {movie.title: movie.id for movie in movies}
+    # Database ids for every pickle row, reused for sources and targets
+    src_ids = map_movie_ids(movie_data['title'])
+    
+    # Load existing pairs once so re-runs skip them without a query per pair
+    existing = set(map(tuple, db.session.execute(
+        db.select(Recommendation.source_movie_id, Recommendation.recommended_movie_id)
+    ).all()))
     
     recommendation_count = 0
+    rows = []
     
-    for i, row in movie_data.iterrows():
-        try:
-            source_title = row['title']
-            source_movie_id = movie_id_map.get(source_title)
-            
-            if not source_movie_id:
-                continue
-            
-            # Get similarity scores for this movie
-            similarity_scores = list(enumerate(similarity_matrix[i]))
-            similarity_scores = sorted(similarity_scores, key=lambda x: x[1], reverse=True)
-            
-            # Create top 10 recommendations (excluding the movie itself)
-            for rank, (target_index, score) in enumerate(similarity_scores[1:11], 1):
-                try:
-                    target_title = movie_data.iloc[target_index]['title']
-                    target_movie_id = movie_id_map.get(target_title)
-                    
-                    if not target_movie_id:
-                        continue
-                    
-                    # Check if recommendation already exists
-                    existing_rec = Recommendation.query.filter_by(
-                        source_movie_id=source_movie_id,
-                        recommended_movie_id=target_movie_id
-                    ).first()
-                    
-                    if existing_rec:
+    now = datetime.utcnow()
+    
+    try:
+        # Run inside a savepoint so a failed phase does not undo earlier ones
+        with db.session.begin_nested():
+            for i, top_idx in enumerate(iter_top_indices(similarity_matrix)):
+                source_movie_id = int(src_ids[i])
+                
+                if not source_movie_id:
+                    continue
+                
+                # Create top 10 recommendations (excluding the movie itself)
+                scores = np.asarray(similarity_matrix[i])[top_idx]
+                for rank, (target_movie_id, score) in enumerate(
+                    zip(src_ids[top_idx].tolist(), scores.tolist()), 1
+                ):
+                    if not target_movie_id or (source_movie_id, target_movie_id) in existing:
                         continue
                     
-                    # Create recommendation
-                    recommendation = Recommendation(
-                        source_movie_id=source_movie_id,
-                        recommended_movie_id=target_movie_id,
-                        similarity_score=float(score),
-                        rank=rank,
-                        created_at=datetime.utcnow()
-                    )
-                    
-                    db.session.add(recommendation)
-                    recommendation_count += 1
-                    
-                except Exception as e:
-                    logger.error(f"Error creating recommendation for {source_title}: {str(e)}")
-                    continue
-            
-            # Commit in batches
-            if recommendation_count % 100 == 0:
-                db.session.commit()
-                logger.info(f"Created {recommendation_count} recommendations so far...")
+                    rows.append({
+                        'source_movie_id': source_movie_id,
+                        'recommended_movie_id': target_movie_id,
+                        'similarity_score': float(score),
+                        'rank': rank,
+                        'created_at': now
+                    })
                 
-        except Exception as e:
-            logger.error(f"Error processing movie {source_title}: {str(e)}")
-            continue
-    
-    # Final commit
-    try:
-        db.session.commit()
+                # Insert in batches
+                if len(rows) >= BATCH_SIZE:
+                    recommendation_count += insert_rows(Recommendation, rows)
+                    rows = []
+                    logger.info(f"Created {recommendation_count} recommendations so far...")
+            
+            # Insert the final partial batch
+            if rows:
+                recommendation_count += insert_rows(Recommendation, rows)
+            
         logger.info(f"Similarity data migration completed: {recommendation_count} recommendations created")
         return True
+        
     except Exception as e:
-        logger.error(f"Error committing similarity data: {str(e)}")
-        db.session.rollback()
+        logger.error(f"Error migrating similarity data: {str(e)}")
         return False
 
+def quantize_similarity(scores):
+    """Quantize similarity scores in [-1, 1] to int8 with a 1/127 scale"""
+    return np.clip(np.round(np.asarray(scores) * 127), -128, 127).astype(np.int8)
+
 def migrate_similarity_matrix(movie_data, similarity_matrix):
     """Store the similarity matrix in the database for future use"""
     logger.info("Starting similarity matrix migration...")
     
-    movies = Movie.query.all()
-    movie_id_map = {movie.title: movie.id for movie in movies}
+    # Map pickle row positions to database ids once (0 marks a missing movie)
+    id_arr = map_movie_ids(movie_data['title'])
+    
+    # Load existing pairs once so re-runs skip them without a query per pair
+    existing = set(map(tuple, db.session.execute(
+        db.select(SimilarityMatrix.movie1_id, SimilarityMatrix.movie2_id)
+    ).all()))
     
     matrix_count = 0
     
-    for i, row1 in movie_data.iterrows():
-        for j, row2 in movie_data.iterrows():
-            if i >= j:  # Avoid duplicates and self-similarity
-                continue
-            
-            try:
-                movie1_id = movie_id_map.get(row1['title'])
-                movie2_id = movie_id_map.get(row2['title'])
-                
-                if not movie1_id or not movie2_id:
-                    continue
-                
-                # Check if similarity already exists
-                existing_sim = SimilarityMatrix.query.filter_by(
-                    movie1_id=movie1_id,
-                    movie2_id=movie2_id
-                ).first()
+    now = datetime.utcnow()
+    
+    try:
+        # Run inside a savepoint so a failed phase does not undo earlier ones
+        with db.session.begin_nested():
+            # Threshold the same matrix the recommendations come from, a block
+            # of rows at a time, and insert each block's pairs before reading
+            # the next, so only one block's pairs are ever held in memory
+            for start in range(0, similarity_matrix.shape[0], BLOCK_ROWS):
+                block = np.asarray(similarity_matrix[start:start + BLOCK_ROWS])
                 
-                if existing_sim:
-                    continue
+                # (i, j) pairs above the diagonal with significant similarity
+                rows, cols = np.nonzero(block > 0.01)
+                upper = cols > rows + start
+                rows, cols = rows[upper], cols[upper]
                 
-                similarity_score = float(similarity_matrix[i][j])
+                # Store scores as int8 (score * 127); cosine similarity lies in [-1, 1]
+                scores_q = quantize_similarity(block[rows, cols])
+                movie1_ids, movie2_ids = id_arr[rows + start], id_arr[cols]
+                mask = (movie1_ids > 0) & (movie2_ids > 0)
                 
-                # Only store significant similarities to save space
-                if similarity_score > 0.01:
-                    sim_record = SimilarityMatrix(
-                        movie1_id=movie1_id,
-                        movie2_id=movie2_id,
-                        similarity_score=similarity_score,
-                        algorithm='cosine_similarity',
-                        created_at=datetime.utcnow()
-                    )
+                batch = []
+                for movie1_id, movie2_id, similarity_score_q in zip(
+                    movie1_ids[mask].tolist(), movie2_ids[mask].tolist(), scores_q[mask].tolist()
+                ):
+                    if (movie1_id, movie2_id) in existing:
+                        continue
                     
-                    db.session.add(sim_record)
-                    matrix_count += 1
-                
-                # Commit in batches
-                if matrix_count % 200 == 0:
-                    db.session.commit()
-                    logger.info(f"Stored {matrix_count} similarity pairs so far...")
+                    batch.append({
+                        'movie1_id': movie1_id,
+                        'movie2_id': movie2_id,
+                        'similarity_score_q': similarity_score_q,
+                        'algorithm': 'cosine_similarity',
+                        'created_at': now
+                    })
                     
-            except Exception as e:
-                logger.error(f"Error storing similarity between {row1['title']} and {row2['title']}: {str(e)}")
-                continue
-    
-    # Final commit
-    try:
-        db.session.commit()
+                    # Insert in batches
+                    if len(batch) >= BATCH_SIZE:
+                        matrix_count += insert_rows(SimilarityMatrix, batch)
+                        batch = []
+                
+                # Insert the rest of the block
+                if batch:
+                    matrix_count += insert_rows(SimilarityMatrix, batch)
+                logger.info(f"Stored {matrix_count} similarity pairs so far...")
+            
         logger.info(f"Similarity matrix migration completed: {matrix_count} pairs stored")
         return True
+        
     except Exception as e:
-        logger.error(f"Error committing similarity matrix: {str(e)}")
-        db.session.rollback()
+        logger.error(f"Error migrating similarity matrix: {str(e)}")
         return False
 
 def main():
@@ -239,18 +511,39 @@ def main():
             logger.error(f"Error creating database tables: {str(e)}")
             return False
         
-        # Migrate movies
-        if not migrate_movies(movie_data):
-            logger.error("Movie migration failed. Exiting.")
+        if not upgrade_similarity_matrix():
+            logger.error("Similarity matrix table upgrade failed. Exiting.")
             return False
         
-        # Migrate recommendations
-        if not migrate_similarity_data(movie_data, similarity_matrix):
-            logger.error("Recommendation migration failed. Continuing...")
+        # All phases share one transaction, committed once at the end. Rows
+        # go through Core inserts, so there is nothing for the ORM to flush
+        relax_durability()
+        with db.session.no_autoflush:
+            # Migrate movies
+            if not migrate_movies(movie_data):
+                logger.error("Movie migration failed. Exiting.")
+                db.session.rollback()
+                return False
+            
+            # Migrate recommendations
+            with deferred_indexes(Recommendation):
+                if not migrate_similarity_data(movie_data, similarity_matrix):
+                    logger.error("Recommendation migration failed. Continuing...")
+            
+            # Storing every pair in the SimilarityMatrix table is opt-in; the
+            # app serves from the Recommendation table and top 10 files
+            if os.environ.get('MIGRATE_SIMILARITY_MATRIX') == '1':
+                with deferred_indexes(SimilarityMatrix):
+                    if not migrate_similarity_matrix(movie_data, similarity_matrix):
+                        logger.error("Similarity matrix migration failed. Continuing...")
         
-        # Migrate similarity matrix (optional, for advanced features)
-        if not migrate_similarity_matrix(movie_data, similarity_matrix):
-            logger.error("Similarity matrix migration failed. Continuing...")
+        try:
+            db.session.commit()
+        except Exception as e:
+            logger.error(f"Error committing migration: {str(e)}")
+            db.session.rollback()
+            return False
+        checkpoint()
         
         # Print summary
         movie_count = Movie.query.count()
@@ -189,7 +189,8 @@ class SimilarityMatrix(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     movie1_id = db.Column(db.Integer, db.ForeignKey('movies.id'), nullable=False)
     movie2_id = db.Column(db.Integer, db.ForeignKey('movies.id'), nullable=False)
-    similarity_score = db.Column(db.Float, nullable=False)
+    similarity_score = db.Column(db.Float, nullable=True)  # Legacy full-precision score
+    similarity_score_q = db.Column(db.SmallInteger, nullable=True)  # Score quantized as round(score * 127)
     algorithm = db.Column(db.String(50), default='cosine_similarity')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -200,9 +201,13 @@ class SimilarityMatrix(db.Model):
     # Indexes for performance
     __table_args__ = (
         db.UniqueConstraint('movie1_id', 'movie2_id', name='unique_movie_pair'),
-        db.Index('idx_movie1_similarity', 'movie1_id', 'similarity_score'),
-        db.Index('idx_movie2_similarity', 'movie2_id', 'similarity_score')
+        db.Index('idx_movie1_similarity', 'movie1_id', 'similarity_score_q'),
+        # Reverse lookups only care about strong matches (score > 0.1)
+        db.Index('idx_movie2_similarity', 'movie2_id', 'similarity_score_q',
+                 postgresql_where=db.text('similarity_score_q > 12'),
+                 sqlite_where=db.text('similarity_score_q > 12'))
     )
     
     def __repr__(self):
-        return f'<SimilarityMatrix {self.movie1.title} <-> {self.movie2.title}: {self.similarity_score}>'
\ No newline at end of file
+        score = self.similarity_score_q / 127.0 if self.similarity_score_q is not None else self.similarity_score
+        return f'<SimilarityMatrix {self.movie1.title} <-> {self.movie2.title}: {score}>'
\ No newline at end of file